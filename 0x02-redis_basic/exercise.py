@@ -4,54 +4,294 @@ This module defines a Cache class for storing and retrieving data from Redis.
 It also includes decorators to count method calls, store call history, and replay them.
 """
 
+import atexit
+import inspect
+import os
+import queue
 import redis
-import uuid
-from functools import wraps
+import socket
+import threading
+import time
+import warnings
+from contextlib import contextmanager
+from functools import partial, wraps
+from redis.utils import HIREDIS_AVAILABLE
 from typing import Union, Callable, Optional
 
 
+if not HIREDIS_AVAILABLE:
+    warnings.warn("hiredis is not installed; redis-py falls back to its "
+                  "pure-Python reply parser. Install redis[hiredis].",
+                  RuntimeWarning)
+
+
+def _connection_pool() -> redis.ConnectionPool:
+    """
+    Build the connection pool shared by every Cache instance and replay.
+
+    The local UNIX socket is preferred since it skips the loopback TCP
+    stack; TCP with keepalive is used when the socket is not available.
+    """
+    socket_path = os.environ.get("REDIS_SOCKET", "/tmp/redis.sock")
+    if os.path.exists(socket_path):
+        return redis.ConnectionPool(
+            connection_class=redis.UnixDomainSocketConnection,
+            path=socket_path)
+    keepalive_options = {}
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        keepalive_options[socket.TCP_KEEPIDLE] = 30
+    return redis.ConnectionPool(host="localhost", port=6379,
+                                socket_keepalive=True,
+                                socket_keepalive_options=keepalive_options)
+
+
+_POOL = _connection_pool()
+
+_local = threading.local()
+
+_urandom = os.urandom
+
+_decode_utf8 = bytes.decode
+
+_REPLAY_CHUNK = 1000
+
+_SCALARS = frozenset((bytes, str, int, float))
+
+_STORE_SCRIPT = """
+redis.call('INCR', KEYS[1])
+redis.call('RPUSH', KEYS[2], ARGV[1])
+redis.call('SET', KEYS[4], ARGV[2])
+redis.call('RPUSH', KEYS[3], ARGV[3])
+return ARGV[3]
+"""
+
+
+@contextmanager
+def _call_pipeline(client: redis.Redis):
+    """
+    Open a non-transactional pipeline for the decorated call in progress.
+
+    The outermost decorator owns the pipeline and flushes it in a single
+    round trip once the call finishes, whether it returned or raised, so
+    failed calls are still counted. Nested decorators queue their commands
+    onto the same pipeline when they use the same connection pool;
+    otherwise they open their own.
+    """
+    outer = getattr(_local, "pipe", None)
+    if outer is not None and outer.connection_pool is client.connection_pool:
+        yield outer
+        return
+    pipe = _local.pipe = client.pipeline(transaction=False)
+    try:
+        yield pipe
+    finally:
+        _local.pipe = outer
+        try:
+            pipe.execute()
+        finally:
+            pipe.reset()
+
+
+_history_queue = queue.Queue()
+
+_history_worker = None
+
+_history_lock = threading.Lock()
+
+
+def _drain_history() -> None:
+    """
+    Write-behind worker for call history entries.
+
+    Each entry holds the Redis client of the decorated instance and both
+    the input and the output of one call. Entries are taken off the queue
+    in batches of up to 256, waiting at most 5 ms for a batch to fill,
+    grouped by connection pool, and pushed with one RPUSH per key inside
+    a MULTI/EXEC per pool. History is best effort: a group that fails is
+    dropped as a whole, so inputs and outputs stay paired and the worker
+    keeps running.
+    """
+    while True:
+        batch = [_history_queue.get()]
+        deadline = time.monotonic() + 0.005
+        while len(batch) < 256:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(_history_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        groups = {}
+        for client, inputs_key, input_data, outputs_key, output in batch:
+            _, values_by_key = groups.setdefault(
+                id(client.connection_pool), (client, {}))
+            values_by_key.setdefault(inputs_key, []).append(input_data)
+            values_by_key.setdefault(outputs_key, []).append(output)
+        try:
+            for client, values_by_key in groups.values():
+                pipe = client.pipeline(transaction=True)
+                for key, values in values_by_key.items():
+                    pipe.rpush(key, *values)
+                try:
+                    pipe.execute()
+                except redis.RedisError:
+                    pass
+        finally:
+            for _ in batch:
+                _history_queue.task_done()
+
+
+def _queue_history(entry) -> None:
+    """
+    Queue a call history entry, starting the write-behind worker on first
+    use so importing this module does not spawn a thread.
+    """
+    global _history_worker
+    if _history_worker is None:
+        with _history_lock:
+            if _history_worker is None:
+                _history_worker = threading.Thread(
+                    target=_drain_history, name="history-writer",
+                    daemon=True)
+                _history_worker.start()
+                atexit.register(_history_queue.join)
+    _history_queue.put_nowait(entry)
+
+
+def _history_keys(method_name: str):
+    """
+    Return the call counter, inputs and outputs keys for a method,
+    already encoded so redis-py sends them without re-encoding.
+
+    The qualified name is wrapped in a {hash tag} so Redis Cluster keeps
+    all three keys in one slot, letting them share a pipeline or script.
+    """
+    return (f"{{{method_name}}}:count".encode(),
+            f"{{{method_name}}}:inputs".encode(),
+            f"{{{method_name}}}:outputs".encode())
+
+
+def _prefixed_keys(keys_by_prefix: dict, instance, keys: tuple) -> tuple:
+    """
+    Return keys prefixed with the instance's key namespace, building and
+    caching them the first time a namespace is seen.
+    """
+    prefix = getattr(instance, "_key_prefix", b"")
+    prefixed = keys_by_prefix.get(prefix)
+    if prefixed is None:
+        prefixed = keys_by_prefix[prefix] = tuple(
+            prefix + key for key in keys)
+    return prefixed
+
+
+def _history_value(value):
+    """
+    Return a call result that redis-py can push as-is when it is a plain
+    scalar, otherwise its repr.
+
+    Inputs keep the tuple repr of the arguments instead, so replay can
+    show them as the original call and bytes stay ASCII-safe.
+    """
+    return value if type(value) in _SCALARS else repr(value)
+
+
+def _store_frame_prefix(sha: str, keys, key_prefix: bytes,
+                        key_length: int) -> bytes:
+    """
+    Pre-encode the fixed head of the store script's EVALSHA command in
+    RESP: command name, script SHA, key count and the tracking keys,
+    followed by the length header and namespace of the data key.
+    """
+    parts = [b"*10\r\n$7\r\nEVALSHA\r\n$40\r\n", sha.encode(),
+             b"\r\n$1\r\n4\r\n"]
+    for key in keys:
+        parts.append(b"$%d\r\n%s\r\n" % (len(key), key))
+    parts.append(b"$%d\r\n%s" % (len(key_prefix) + key_length, key_prefix))
+    return b"".join(parts)
+
+
+def _connection_getter(pool: redis.ConnectionPool) -> Callable:
+    """
+    Return a callable that checks a connection out of the pool.
+
+    redis-py 5.3+ deprecates passing a command name to get_connection,
+    while older releases require one, so the name is only bound when
+    the installed version has no default for it.
+    """
+    param = inspect.signature(pool.get_connection).parameters.get(
+        "command_name")
+    if param is None or param.default is not param.empty:
+        return pool.get_connection
+    return partial(pool.get_connection, "EVALSHA")
+
+
 def count_calls(method: Callable) -> Callable:
     """
     Decorator that counts how many times a method is called.
-    Stores the count in Redis using the method's qualified name as key.
+    Stores the count in Redis under the method's call counter key.
     """
+    keys = _history_keys(method.__qualname__)[:1]
+    keys_by_prefix = {b"": keys}
+
     @wraps(method)
     def wrapper(self, *args, **kwargs):
-        self._redis.incr(method.__qualname__)
-        return method(self, *args, **kwargs)
+        count_key, = _prefixed_keys(keys_by_prefix, self, keys)
+        with _call_pipeline(self._redis) as pipe:
+            pipe.incr(count_key)
+            return method(self, *args, **kwargs)
     return wrapper
 
 
 def call_history(method: Callable) -> Callable:
     """Store the history of inputs and outputs for a function in Redis."""
+    keys = _history_keys(method.__qualname__)[1:]
+    keys_by_prefix = {b"": keys}
+
     @wraps(method)
     def wrapper(self, *args, **kwargs):
-        input_data = str(args)
-        method_name = method.__qualname__
-        inputs_key = f"{method_name}:inputs"
-        outputs_key = f"{method_name}:outputs"
-
-        self._redis.rpush(inputs_key, input_data)
+        inputs_key, outputs_key = _prefixed_keys(keys_by_prefix, self, keys)
+        input_data = repr(args)
         result = method(self, *args, **kwargs)
-        self._redis.rpush(outputs_key, result)
-
+        _queue_history((self._redis, inputs_key, input_data,
+                        outputs_key, _history_value(result)))
         return result
     return wrapper
 
 
 def replay(method: Callable):
-    """Display the history of calls of a particular function."""
-    r = redis.Redis()
+    """
+    Display the history of calls of a particular function.
+
+    The history is read in windows of _REPLAY_CHUNK entries, so memory
+    stays bounded however long the lists grow.
+    """
+    _history_queue.join()
+    instance = getattr(method, "__self__", None)
+    r = getattr(instance, "_redis", None)
+    if r is None:
+        r = redis.Redis(connection_pool=_POOL)
     method_name = method.__qualname__
-    inputs_key = f"{method_name}:inputs"
-    outputs_key = f"{method_name}:outputs"
+    prefix = getattr(instance, "_key_prefix", b"")
+    count_key, inputs_key, outputs_key = (
+        prefix + key for key in _history_keys(method_name))
 
-    inputs = r.lrange(inputs_key, 0, -1)
-    outputs = r.lrange(outputs_key, 0, -1)
+    pipe = r.pipeline(transaction=False)
+    pipe.get(count_key)
+    pipe.llen(inputs_key)
+    count, length = pipe.execute()
 
-    print(f"{method_name} was called {len(inputs)} times:")
-    for inp, out in zip(inputs, outputs):
-        print(f"{method_name}(*{inp.decode('utf-8')}) -> {out.decode('utf-8')}")
+    decode = bytes.decode
+    print(f"{method_name} was called {int(count or 0)} times:")
+    for start in range(0, length, _REPLAY_CHUNK):
+        end = start + _REPLAY_CHUNK - 1
+        pipe.lrange(inputs_key, start, end)
+        pipe.lrange(outputs_key, start, end)
+        inputs, outputs = pipe.execute()
+        for inp, out in zip(inputs, outputs):
+            print(f"{method_name}(*{decode(inp, 'utf-8', 'backslashreplace')})"
+                  f" -> {decode(out, 'utf-8', 'backslashreplace')}")
 
 
 class Cache:
@@ -60,30 +300,96 @@ class Cache:
     Includes storing, retrieving, tracking usage, and replaying call history.
     """
 
-    def __init__(self) -> None:
+    __slots__ = ("_redis", "_get", "_get_connection", "_release",
+                 "_encoder", "_namespace", "_key_prefix", "_store_script",
+                 "_store_keys", "_store_tag", "_store_frame")
+
+    def __init__(self, reset: bool = False, namespace: str = "") -> None:
         """
-        Initialize Redis connection and flush the database.
+        Initialize Redis connection, optionally flushing the database.
+
+        The Redis and pool methods used on the hot path are bound once
+        here, so calls skip the per-call attribute lookups.
+
+        Args:
+            reset: Flush the whole Redis database first. This is O(n) in
+                the number of keys and drops every other client's data,
+                so it is meant for tests and demos only.
+            namespace: Prefix for every key this instance reads or
+                writes, separated by a colon, so caches can share a
+                database without clashing.
         """
-        self._redis = redis.Redis()
-        self._redis.flushdb()
+        r = redis.Redis(connection_pool=_POOL)
+        self._redis = r
+        self._get = r.get
+        self._get_connection = _connection_getter(_POOL)
+        self._release = _POOL.release
+        self._encoder = _POOL.get_encoder()
+        self._namespace = f"{namespace}:" if namespace else ""
+        self._key_prefix = self._namespace.encode()
+        if reset:
+            r.flushdb()
+        self._store_script = r.register_script(_STORE_SCRIPT)
+        method_name = self.store.__qualname__
+        self._store_keys = tuple(
+            self._key_prefix + key for key in _history_keys(method_name))
+        self._store_tag = f"{{{method_name}}}:"
+        self._store_frame = _store_frame_prefix(
+            self._store_script.sha, self._store_keys, self._key_prefix,
+            len(self._store_tag) + 32)
 
-    @count_calls
-    @call_history
     def store(self, data: Union[str, bytes, int, float]) -> str:
         """
-        Store data in Redis under a randomly generated UUID key.
+        Store data in Redis under a randomly generated key.
+
+        The key is a random hex string behind the same {hash tag} as the
+        tracking keys, so the script only touches keys it declares and
+        that all live in one Redis Cluster slot.
+
+        The call count and input/output history that count_calls and
+        call_history would record are written by a server-side Lua script,
+        so the whole operation is a single atomic EVALSHA round trip.
+
+        The EVALSHA command is written as a RESP frame spliced onto a
+        prefix built in __init__, bypassing redis-py's argument packing;
+        if the server does not have the script cached yet, the call falls
+        back to redis-py, which loads it. Connection errors are retried
+        with the connection's Retry policy, as redis-py itself does.
 
         Args:
             data: The data to store (str, bytes, int, float).
 
         Returns:
-            The key under which the data was stored.
+            The key under which the data was stored, relative to the
+            instance's namespace.
         """
-        key = str(uuid.uuid4())
-        self._redis.set(key, data)
+        key = self._store_tag + _urandom(16).hex()
+        encoded_key = key.encode()
+        value = data if type(data) is bytes else self._encoder.encode(data)
+        inputs = repr((data,)).encode()
+        frame = b"%s%s\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n$%d\r\n%s\r\n" % (
+            self._store_frame, encoded_key, len(inputs), inputs,
+            len(value), value, len(encoded_key), encoded_key)
+
+        connection = self._get_connection()
+
+        def send():
+            connection.send_packed_command([frame])
+            return connection.read_response()
+
+        try:
+            connection.retry.call_with_retry(
+                send, lambda error: connection.disconnect())
+        except redis.exceptions.NoScriptError:
+            self._store_script(
+                keys=self._store_keys + (self._key_prefix + encoded_key,),
+                args=[inputs, value, encoded_key])
+        finally:
+            self._release(connection)
         return key
 
-    def get(self, key: str, fn: Optional[Callable] = None) -> Union[bytes, str, int, float, None]:
+    def get(self, key: Union[str, bytes], fn: Optional[Callable] = None
+            ) -> Union[bytes, str, int, float, None]:
         """
         Retrieve data from Redis and optionally apply a conversion function.
 
@@ -94,7 +400,9 @@ class Cache:
         Returns:
             The retrieved (and possibly converted) data, or None if key does not exist.
         """
-        data = self._redis.get(key)
+        prefix = (self._key_prefix if isinstance(key, bytes)
+                  else self._namespace)
+        data = self._get(prefix + key)
         if data is None:
             return None
         return fn(data) if fn else data
@@ -109,16 +417,22 @@ class Cache:
         Returns:
             The decoded string, or None.
         """
-        return self.get(key, fn=lambda d: d.decode("utf-8"))
+        return self.get(key, fn=_decode_utf8)
 
-    def get_int(self, key: str) -> Optional[int]:
+    def get_int(self, key: Union[str, bytes]) -> Optional[int]:
         """
         Retrieve an integer value from Redis.
 
+        The stored decimal bytes are parsed by int() directly, without
+        going through get's conversion callback.
+
         Args:
             key: The Redis key.
 
         Returns:
             The integer representation, or None.
         """
-        return self.get(key, fn=int)
+        prefix = (self._key_prefix if isinstance(key, bytes)
+                  else self._namespace)
+        data = self._get(prefix + key)
+        return None if data is None else int(data)
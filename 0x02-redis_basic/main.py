@@ -3,13 +3,13 @@
 Main file
 """
 
+import asyncio
 import redis
 from exercise import Cache, replay
-from web import get_page
-import time
+from web import close, get_page
 
 # Task 0: Store a value in Redis
-cache = Cache()
+cache = Cache(reset=True)
 data = b"hello"
 key = cache.store(data)
 print(key)
@@ -29,13 +29,13 @@ for value, fn in TEST_CASES.items():
     assert cache.get(key, fn=fn) == value
 
 # Task 2: Count method calls
-cache = Cache()
+cache = Cache(reset=True)
 cache.store(b"first")
-print(cache.get(cache.store.__qualname__))  # Should print: b'1'
+print(cache.get(f"{{{cache.store.__qualname__}}}:count"))  # Should print: b'1'
 
 cache.store(b"second")
 cache.store(b"third")
-print(cache.get(cache.store.__qualname__))  # Should print: b'3'
+print(cache.get(f"{{{cache.store.__qualname__}}}:count"))  # Should print: b'3'
 
 # Task 3: Log input/output history
 s1 = cache.store("first")
@@ -45,23 +45,34 @@ print(s2)
 s3 = cache.store("third")
 print(s3)
 
-inputs = cache._redis.lrange(f"{cache.store.__qualname__}:inputs", 0, -1)
-outputs = cache._redis.lrange(f"{cache.store.__qualname__}:outputs", 0, -1)
+inputs = cache._redis.lrange(f"{{{cache.store.__qualname__}}}:inputs", 0, -1)
+outputs = cache._redis.lrange(f"{{{cache.store.__qualname__}}}:outputs", 0, -1)
 
 print("inputs: {}".format(inputs))
 print("outputs: {}".format(outputs))
 
 # Task 4: Replay the method call history
-cache = Cache()
+cache = Cache(reset=True)
 cache.store("foo")
 cache.store("bar")
 cache.store(42)
 replay(cache.store)
 
+# Replay must cope with binary, non-UTF-8 payloads
+cache = Cache(reset=True)
+cache.store(b"\xff\xd8\xff\xe0")
+replay(cache.store)
+
 
 url = "http://slowwly.robertomurray.co.uk/delay/2000/url/http://example.com"
 
-print(get_page(url))  # First call: fetches from web (2s delay)
-print(get_page(url))  # Second call: cached (immediate)
-time.sleep(10)
-print(get_page(url))  # After TTL: fetch again (2s delay)
+
+async def fetch_pages():
+    print(await get_page(url))  # First call: fetches from web (2s delay)
+    print(await get_page(url))  # Second call: cached (immediate)
+    await asyncio.sleep(10)
+    print(await get_page(url))  # After TTL: fetch again (2s delay)
+    await close()
+
+
+asyncio.run(fetch_pages())
@@ -1,38 +1,200 @@
 #!/usr/bin/env python3
 '''A module with tools for request caching and tracking.
 '''
-import redis
-import requests
+import asyncio
+import httpx
+import os
+import redis.asyncio as aioredis
+import socket
+import time
 from functools import wraps
-from typing import Callable
+from redis.asyncio.connection import UnixDomainSocketConnection
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
 
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
 
-redis_store = redis.Redis()
-'''The module-level Redis instance.
+
+def _connection_pool() -> aioredis.ConnectionPool:
+    '''Builds the connection pool, preferring the local UNIX socket
+    and falling back to TCP with keepalive.
+    '''
+    socket_path = os.environ.get('REDIS_SOCKET', '/tmp/redis.sock')
+    if os.path.exists(socket_path):
+        return aioredis.ConnectionPool(
+            connection_class=UnixDomainSocketConnection,
+            path=socket_path,
+        )
+    keepalive_options = {}
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        keepalive_options[socket.TCP_KEEPIDLE] = 30
+    return aioredis.ConnectionPool(
+        host='localhost',
+        port=6379,
+        socket_keepalive=True,
+        socket_keepalive_options=keepalive_options,
+    )
+
+
+_RELEASE_LOCK_SCRIPT = '''
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+'''
+'''Deletes a fetch lock only if it still holds the caller's token.
+'''
+
+
+class _LoopClients:
+    '''The Redis and HTTP clients of one event loop, whose connections
+    cannot be shared with any other loop.
+    '''
+    def __init__(self) -> None:
+        '''Creates the clients; connections are opened on first use.
+        '''
+        self.redis = aioredis.Redis(connection_pool=_connection_pool())
+        self.http = httpx.AsyncClient(
+            http2=_HTTP2,
+            headers={'User-Agent': 'cache/1.0'},
+            limits=httpx.Limits(
+                max_connections=64, max_keepalive_connections=16),
+            timeout=5,
+        )
+        self.release_lock = self.redis.register_script(_RELEASE_LOCK_SCRIPT)
+        self.pending_writes: Set[asyncio.Future] = set()
+
+
+_loop_clients: Dict[asyncio.AbstractEventLoop, _LoopClients] = {}
+'''The clients of each event loop that has used this module.
+'''
+
+
+def _clients() -> _LoopClients:
+    '''Returns the clients of the running event loop, creating them on
+    first use and forgetting those of loops that have been closed.
+    '''
+    loop = asyncio.get_running_loop()
+    clients = _loop_clients.get(loop)
+    if clients is None:
+        for stale in [other for other in _loop_clients if other.is_closed()]:
+            del _loop_clients[stale]
+        clients = _loop_clients[loop] = _LoopClients()
+    return clients
+
+
+CACHE_TTL = 10
+'''The number of seconds a fetched page stays cached.
+'''
+LOCK_POLLS = 50
+'''How many times a caller waits for another caller's fetch of the
+same URL before fetching the page itself.
+'''
+LOCK_POLL_INTERVAL = 0.1
+'''The number of seconds between two checks for another caller's fetch.
+'''
+LOCAL_CACHE_SIZE = 1024
+'''The maximum number of pages kept in the process-local cache.
 '''
+_local_cache: Dict[str, Tuple[float, str]] = {}
+'''Process-local copies of fetched pages, keyed by URL, with the
+monotonic time at which each copy expires.
+'''
+
+
+async def _store_result(clients: _LoopClients, url: str, result: str,
+                        lock_token: Optional[str]) -> None:
+    '''Writes a fetched page to Redis, resets its access count and
+    releases its fetch lock if this caller holds it.
+    '''
+    try:
+        pipe = clients.redis.pipeline(transaction=False)
+        pipe.set(f'count:{url}', 0)
+        pipe.setex(f'result:{url}', CACHE_TTL, result)
+        await pipe.execute()
+    finally:
+        if lock_token is not None:
+            await clients.release_lock(
+                keys=[f'lock:{url}'], args=[lock_token])
 
 
-def data_cacher(method: Callable) -> Callable:
+def data_cacher(
+        method: Callable[[str], Awaitable[str]],
+        ) -> Callable[[str], Awaitable[str]]:
     '''Caches the output of fetched data.
     '''
     @wraps(method)
-    def invoker(url) -> str:
+    async def invoker(url) -> str:
         '''The wrapper function for caching the output.
         '''
-        redis_store.incr(f'count:{url}')
-        result = redis_store.get(f'result:{url}')
+        clients = _clients()
+        redis_store = clients.redis
+        now = time.monotonic()
+        local = _local_cache.get(url)
+        if local is not None:
+            if local[0] > now:
+                await redis_store.incr(f'count:{url}')
+                return local[1]
+            del _local_cache[url]
+        pipe = redis_store.pipeline(transaction=False)
+        pipe.incr(f'count:{url}')
+        pipe.get(f'result:{url}')
+        _, result = await pipe.execute()
         if result:
             return result.decode('utf-8')
-        result = method(url)
-        redis_store.set(f'count:{url}', 0)
-        redis_store.setex(f'result:{url}', 10, result)
+        lock_token = os.urandom(16).hex()
+        locked = await redis_store.set(
+            f'lock:{url}', lock_token, nx=True, ex=CACHE_TTL)
+        if not locked:
+            lock_token = None
+            for _ in range(LOCK_POLLS):
+                await asyncio.sleep(LOCK_POLL_INTERVAL)
+                result = await redis_store.get(f'result:{url}')
+                if result:
+                    return result.decode('utf-8')
+        try:
+            result = await method(url)
+        except BaseException:
+            if lock_token is not None:
+                await clients.release_lock(
+                    keys=[f'lock:{url}'], args=[lock_token])
+            raise
+        task = asyncio.ensure_future(
+            _store_result(clients, url, result, lock_token))
+        clients.pending_writes.add(task)
+        task.add_done_callback(clients.pending_writes.discard)
+        _local_cache.pop(url, None)
+        if len(_local_cache) >= LOCAL_CACHE_SIZE:
+            del _local_cache[min(_local_cache,
+                                 key=lambda u: _local_cache[u][0])]
+        _local_cache[url] = (now + CACHE_TTL, result)
         return result
     return invoker
 
 
 @data_cacher
-def get_page(url: str) -> str:
+async def get_page(url: str) -> str:
     '''Returns the content of a URL after caching the request's response,
     and tracking the request.
     '''
-    return requests.get(url).text
+    response = await _clients().http.get(url)
+    return response.text
+
+
+async def close() -> None:
+    '''Waits for the running loop's pending cache writes, then closes
+    its Redis and HTTP clients. A later call on the same or another loop
+    creates new clients.
+    '''
+    clients = _loop_clients.pop(asyncio.get_running_loop(), None)
+    if clients is None:
+        return
+    if clients.pending_writes:
+        await asyncio.gather(*clients.pending_writes)
+    await clients.http.aclose()
+    # redis-py 5.0.1 renamed close() to aclose() and deprecated close().
+    aclose = getattr(clients.redis, 'aclose', None) or clients.redis.close
+    await aclose()